@@ -1,57 +1,296 @@
 import requests
 import json
+import orjson
 import logging
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from datetime import datetime
 import os
-from google.cloud import storage
 import sys
-import traceback
 import time
 from flask import Flask, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import quote
 import random
+import itertools
+from collections import deque
+import re
+import hashlib
+import threading
+import atexit
+import gzip
+import html
+from concurrent.futures import ThreadPoolExecutor
 
-# Set up detailed logging
+# Set up detailed logging. LOG_LEVEL=WARNING keeps only problems, which cuts
+# Cloud Logging volume on a service that runs every hour. An unknown level
+# falls back to INFO rather than failing the import and the whole service.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int)
 logging.basicConfig(
-    level=logging.INFO,
+    level=LOG_LEVEL if log_level_valid else logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
+if not log_level_valid:
+    logging.warning(f"Unknown LOG_LEVEL '{LOG_LEVEL}'. Logging at INFO instead.")
 
 # Configuration (use environment variables for sensitive data)
 WOOT_API_KEY = os.environ.get("WOOT_API_KEY")
 FEED_ENDPOINT = "https://developer.woot.com/feed/All"  # Changed to All to search everything
 GETOFFERS_ENDPOINT = "https://developer.woot.com/getoffers"
+# Request headers for Woot API calls, built once. They're passed per call rather
+# than set on the shared session so the API key is never sent to other hosts.
+WOOT_HEADERS = {
+    "x-api-key": WOOT_API_KEY,
+    "Accept": "application/json"
+}
+WOOT_JSON_HEADERS = dict(WOOT_HEADERS, **{"Content-Type": "application/json"})
 KEYWORDS = ["kindle", "ereader", "e-reader", "e-ink", "kobo", "nook", "eink", "treadmill", "walking pad"]
+# All keywords compiled into one case-insensitive pattern so a field is scanned once
+KEYWORD_RE = re.compile("|".join(re.escape(keyword) for keyword in KEYWORDS), re.IGNORECASE)
+# Detailed offer fields searched for keywords
+DEAL_TEXT_FIELDS = ("Title", "WriteUpBody", "Features", "Subtitle", "Snippet")
+# Feed item fields searched by the prefilter (the feed's field casing varies)
+PREFILTER_FIELDS = (
+    "Title", "title",
+    "Description", "description",
+    "Subtitle", "subtitle",
+    "Snippet", "snippet",
+    "Summary", "summary",
+    "Name", "name",
+    "ProductName", "productName",
+    "WriteUpBody", "writeUpBody",
+    "Features", "features"
+)
 
 # Gmail configuration
 GMAIL_USER = os.environ.get("GMAIL_USER")
 GMAIL_APP_PASSWORD = os.environ.get("GMAIL_APP_PASSWORD")
 EMAIL_RECIPIENT = os.environ.get("EMAIL_RECIPIENT")
+# EMAIL_RECIPIENT may hold several comma-separated addresses
+EMAIL_RECIPIENTS = [address.strip() for address in (EMAIL_RECIPIENT or "").split(",") if address.strip()]
+# HTML for one deal in the notification email, filled in by format_deal_notifications
+DEAL_EMAIL_TEMPLATE = """
+<h2>{title}</h2>
+<p><strong>Price:</strong> {price}</p>
+<p><strong>URL:</strong> <a href="{url}">{url}</a></p>
+<hr>
+<p><small>Sent by your Woot Deals alert system</small></p>
+"""
 
 # GCS configuration
 BUCKET_NAME = os.environ.get("BUCKET_NAME")
-SEEN_DEALS_FILENAME = "seen_deals.json"
+SEEN_DEALS_FILENAME = "seen_deals.txt.gz"
+# Uncompressed file used by earlier versions, read once if the new one doesn't exist yet
+LEGACY_SEEN_DEALS_FILENAME = "seen_deals.json"
+# Seen deals are forgotten once they haven't been in the feed for this long
+SEEN_DEALS_MAX_AGE = 30 * 24 * 60 * 60  # seconds
+# How stale a seen deal's last-seen time can get before a run refreshes it.
+# Refreshing only this often keeps runs where nothing changed from saving.
+SEEN_DEALS_REFRESH_INTERVAL = 24 * 60 * 60  # seconds
+# Storage is accessed through the JSON API with the shared session rather than
+# the google-cloud-storage SDK, which is slow to import on cold start
+GCS_API_ENDPOINT = "https://storage.googleapis.com/storage/v1"
+GCS_UPLOAD_ENDPOINT = "https://storage.googleapis.com/upload/storage/v1"
+METADATA_TOKEN_ENDPOINT = "http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token"
+
+# Service account access token from the metadata server, reused until it expires
+gcs_token_cache = {"token": None, "expires_at": 0}
+
+# Result of the required environment variable check. The values are read once at
+# import, so warm invocations can reuse the first answer.
+env_check_cache = {"all_set": None}
+
+# Seen deals from the last load/save, keyed by the blob generation they match.
+# Warm invocations reuse the parsed set when the stored file hasn't changed.
+seen_deals_cache = {"generation": None, "seen_deals": {}}
+
+# Normalized feed pages from previous warm invocations, keyed by page URL, along
+# with the validators (ETag / Last-Modified) and body digest used to revalidate them
+feed_page_cache = {}
+# Pages fetched less than this many seconds ago are reused without a request, so
+# back-to-back invocations (scheduler retries, manual runs) share one fetch
+FEED_CACHE_TTL = int(os.environ.get("FEED_CACHE_TTL", 60))
+
+# Logged-in SMTP connection kept open between sends so later emails skip the
+# TLS handshake and login. Guarded by smtp_lock, since smtplib isn't thread-safe.
+smtp_connection = None
+smtp_lock = threading.Lock()
+
+# Set WOOT_PROFILE=1 to log a cProfile summary of each deals check
+PROFILE_ENABLED = bool(os.environ.get("WOOT_PROFILE"))
 
 # Rate limiting configuration
 MAX_RETRIES = 5
 INITIAL_RETRY_DELAY = 5  # seconds
 MAX_RETRY_DELAY = 60  # seconds
 BASE_DELAY_BETWEEN_BATCHES = 3  # seconds
+OFFERS_BATCH_SIZE = 10  # Reduced from 25 to avoid rate limits
+# The batch size adapts between these bounds: one larger after each successful
+# batch, halved after a 429. The current size carries over to warm invocations.
+MIN_OFFERS_BATCH_SIZE = 5
+MAX_OFFERS_BATCH_SIZE = 25
+offers_batch_size = {"size": OFFERS_BATCH_SIZE}
+offers_batch_size_lock = threading.Lock()
+# getoffers requests in flight at once; raise it if your API key's rate limit allows
+MAX_CONCURRENT_BATCHES = max(1, int(os.environ.get("MAX_CONCURRENT_BATCHES", 2)))
+# Optional cap on Woot API requests per minute across all threads, enforced with a
+# token bucket that allows one request per concurrent batch in a burst. 0 disables it.
+WOOT_REQUESTS_PER_MINUTE = float(os.environ.get("WOOT_REQUESTS_PER_MINUTE", 0))
+WOOT_RATE_LIMIT_BURST = MAX_CONCURRENT_BATCHES
+# paused_until holds every Woot request back after any of them is rate limited (429)
+woot_rate_limit = {"tokens": WOOT_RATE_LIMIT_BURST, "updated_at": time.monotonic(), "paused_until": 0}
+woot_rate_limit_lock = threading.Lock()
 
-# Initialize storage client
-storage_client = None
-try:
-    storage_client = storage.Client()
-    logging.info("Successfully initialized storage client")
-except Exception as e:
-    logging.error(f"Error initializing storage client: {e}")
-    logging.error(traceback.format_exc())
+# Shared HTTP session so repeated calls to the Woot API and Cloud Storage reuse
+# pooled connections (and skip the TCP/TLS handshake) across warm invocations.
+# Each host's pool holds at least one connection per concurrent getoffers batch,
+# so raising MAX_CONCURRENT_BATCHES doesn't mean new handshakes on every run.
+# The adapter retries connection errors and transient 5xx/429 answers to idempotent
+# requests (urllib3's default method list leaves out POST, whose callers handle
+# their own retries), honoring Retry-After.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=max(4, MAX_CONCURRENT_BATCHES),
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+))
+# (connect, read) timeout in seconds for every outbound HTTP request, so a hung
+# connection fails the call instead of holding the request until Cloud Run kills it
+HTTP_TIMEOUT = (3.05, 30)
+# Timeout in seconds for connecting to and talking with the SMTP server
+SMTP_TIMEOUT = 30
 
 # Create Flask app
 app = Flask(__name__)
 
+def get_gcs_access_token():
+    """Get an access token for Cloud Storage from the metadata server, reusing it until shortly before it expires."""
+    if gcs_token_cache["token"] and time.time() < gcs_token_cache["expires_at"]:
+        return gcs_token_cache["token"]
+    
+    response = SESSION.get(METADATA_TOKEN_ENDPOINT, headers={"Metadata-Flavor": "Google"}, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    token_data = orjson.loads(response.content)
+    
+    gcs_token_cache["token"] = token_data["access_token"]
+    # Refresh a minute early so the token can't expire mid-request
+    gcs_token_cache["expires_at"] = time.time() + token_data.get("expires_in", 0) - 60
+    return gcs_token_cache["token"]
+
+def gcs_request(method, url, headers=None, **kwargs):
+    """Make an authenticated request to the Cloud Storage JSON API."""
+    headers = dict(headers or {})
+    headers["Authorization"] = f"Bearer {get_gcs_access_token()}"
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    return SESSION.request(method, url, headers=headers, **kwargs)
+
+def gcs_object_url(object_name):
+    """Build the JSON API URL for an object in the configured bucket."""
+    return f"{GCS_API_ENDPOINT}/b/{BUCKET_NAME}/o/{quote(object_name, safe='')}"
+
+def download_gcs_object(object_name):
+    """Download an object's contents as bytes."""
+    response = gcs_request("GET", gcs_object_url(object_name), params={"alt": "media"})
+    response.raise_for_status()
+    return response.content
+
+def download_gcs_object_if_changed(object_name, known_generation=None):
+    """
+    Download an object's contents and generation in a single request.
+    Returns (content, generation). content is None if the object is still at
+    known_generation (the server answers 304 without a body), and both are None
+    if the object doesn't exist.
+    """
+    params = {"alt": "media"}
+    if known_generation is not None:
+        params["ifGenerationNotMatch"] = known_generation
+    response = gcs_request("GET", gcs_object_url(object_name), params=params)
+    if response.status_code == 404:
+        return None, None
+    if response.status_code == 304:
+        return None, known_generation
+    response.raise_for_status()
+    return response.content, response.headers["x-goog-generation"]
+
+def upload_gcs_object(object_name, data, content_type="text/plain", if_generation_match=None):
+    """
+    Upload data to an object in the configured bucket and return the new object's metadata.
+    With if_generation_match, the upload fails with 412 unless the object is still at that
+    generation (0 requires that it doesn't exist yet).
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    params = {"uploadType": "media", "name": object_name}
+    if if_generation_match is not None:
+        params["ifGenerationMatch"] = if_generation_match
+    response = gcs_request(
+        "POST",
+        f"{GCS_UPLOAD_ENDPOINT}/b/{BUCKET_NAME}/o",
+        params=params,
+        headers={"Content-Type": content_type},
+        data=data
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+def delete_gcs_object(object_name):
+    """Delete an object from the configured bucket."""
+    response = gcs_request("DELETE", gcs_object_url(object_name))
+    response.raise_for_status()
+
+def get_smtp_connection():
+    """
+    Get a logged-in Gmail SMTP connection, reusing the open one if it's still alive.
+    Gmail drops idle sessions after a few minutes, so the connection is checked
+    with NOOP and reopened when needed. Callers must hold smtp_lock.
+    """
+    global smtp_connection
+    import smtplib
+    
+    if smtp_connection is not None:
+        try:
+            if smtp_connection.noop()[0] == 250:
+                logging.info("Reusing open SMTP connection")
+                return smtp_connection
+        except (smtplib.SMTPException, OSError):
+            pass
+        close_smtp_connection()
+    
+    logging.info("Connecting to SMTP server...")
+    server = smtplib.SMTP_SSL('smtp.gmail.com', 465, timeout=SMTP_TIMEOUT)
+    logging.info("SMTP server connected")
+    try:
+        logging.info("Attempting login...")
+        server.login(GMAIL_USER, GMAIL_APP_PASSWORD)
+        logging.info("Login successful")
+    except Exception:
+        server.close()
+        raise
+    
+    smtp_connection = server
+    return server
+
+def close_smtp_connection():
+    """Close the shared SMTP connection, if one is open."""
+    global smtp_connection
+    import smtplib
+    
+    if smtp_connection is None:
+        return
+    try:
+        smtp_connection.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp_connection.close()
+    smtp_connection = None
+
+atexit.register(close_smtp_connection)
+
 def test_environment_variables():
     """Test if all required environment variables are set."""
     logging.info("=== TESTING ENVIRONMENT VARIABLES ===")
@@ -84,42 +323,53 @@ def test_environment_variables():
     
     return all_set
 
+def required_env_vars_set():
+    """Run test_environment_variables on the first call and return its cached result after that."""
+    if env_check_cache["all_set"] is None:
+        env_check_cache["all_set"] = test_environment_variables()
+    return env_check_cache["all_set"]
+
 def test_storage_access():
     """Test access to Cloud Storage."""
     logging.info("=== TESTING CLOUD STORAGE ACCESS ===")
     
-    if not storage_client:
-        logging.error("Storage client initialization failed")
+    if not BUCKET_NAME:
+        logging.error("BUCKET_NAME is not set")
         return False
     
     try:
+        # Check if we can get an access token
+        get_gcs_access_token()
+        logging.info("Successfully got Cloud Storage access token")
+        
         # Check if the bucket exists
-        bucket = storage_client.bucket(BUCKET_NAME)
-        exists = bucket.exists()
+        response = gcs_request("GET", f"{GCS_API_ENDPOINT}/b/{BUCKET_NAME}")
         
-        if exists:
+        if response.status_code == 200:
             logging.info(f"Bucket {BUCKET_NAME} exists")
             
             # Test writing to the bucket
-            test_blob = bucket.blob("test_access.txt")
-            test_blob.upload_from_string(f"Test access at {datetime.now().isoformat()}")
+            upload_gcs_object("test_access.txt", f"Test access at {datetime.now().isoformat()}")
             logging.info("Successfully wrote test file to bucket")
             
             # Test reading from the bucket
-            content = test_blob.download_as_text()
+            content = download_gcs_object("test_access.txt").decode("utf-8")
             logging.info(f"Successfully read test file from bucket: {content}")
             
             # Clean up
-            test_blob.delete()
+            delete_gcs_object("test_access.txt")
             logging.info("Successfully deleted test file from bucket")
             
             return True
-        else:
+        elif response.status_code == 404:
             logging.error(f"Bucket {BUCKET_NAME} does not exist")
             return False
+        else:
+            logging.error(f"Failed to access bucket {BUCKET_NAME}. Status code: {response.status_code}")
+            logging.error(f"Response: {response.text}")
+            return False
     except Exception as e:
-        logging.error(f"Error testing storage access: {e}")
-        logging.error(traceback.format_exc())
+        logging.exception(f"Error testing storage access: {e}")
         return False
 
 def test_woot_api():
@@ -130,18 +380,13 @@ def test_woot_api():
         logging.error("WOOT_API_KEY is not set")
         return False
     
-    headers = {
-        "x-api-key": WOOT_API_KEY,
-        "Accept": "application/json"
-    }
-    
     try:
         # Test the feed endpoint
         logging.info(f"Testing connection to feed endpoint: {FEED_ENDPOINT}")
-        response = requests.get(FEED_ENDPOINT, headers=headers)
+        response = woot_request("GET", FEED_ENDPOINT)
         
         if response.status_code == 200:
-            api_response = response.json()
+            api_response = orjson.loads(response.content)
             logging.info(f"Successfully connected to feed endpoint. Received response data.")
             
             # Log details about the response structure
@@ -212,30 +457,27 @@ def test_woot_api():
             
             else:
                 logging.info(f"Response is neither a list nor a dict. Type: {type(api_response)}")
-                # Dump as string to get a sense of what it is
-                logging.info(f"Response preview: {str(api_response)[:500]}...")
+                # Show the start of the raw body to get a sense of what it is
+                logging.info(f"Response preview: {response.content[:500].decode('utf-8', 'replace')}...")
                 
-            # Log full response structure (truncated) for analysis
-            response_str = json.dumps(api_response, indent=2)
-            logging.info(f"Full response structure (truncated): {response_str[:1000]}...")
+            # Log the start of the response for analysis. Slice the raw bytes
+            # rather than re-serializing the whole feed just to truncate it.
+            logging.info(f"Full response structure (truncated): {response.content[:1000].decode('utf-8', 'replace')}...")
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f"Full response structure (pretty-printed): {json.dumps(api_response, indent=2)}")
                 
             # Test the getoffers endpoint if we found an ID
             if offer_id:
                 logging.info(f"Testing connection to getoffers endpoint with OfferId: {offer_id}")
-                getoffers_headers = {
-                    "x-api-key": WOOT_API_KEY,
-                    "Accept": "application/json",
-                    "Content-Type": "application/json"
-                }
-                
-                getoffers_response = requests.post(
+                getoffers_response = woot_request(
+                    "POST",
                     GETOFFERS_ENDPOINT,
-                    headers=getoffers_headers,
-                    data=json.dumps([offer_id])
+                    headers=WOOT_JSON_HEADERS,
+                    data=orjson.dumps([offer_id])
                 )
                 
                 if getoffers_response.status_code == 200:
-                    detailed_offers = getoffers_response.json()
+                    detailed_offers = orjson.loads(getoffers_response.content)
                     logging.info(f"Successfully connected to getoffers endpoint. Received {len(detailed_offers) if isinstance(detailed_offers, list) else 'non-list'} response.")
                     
                     if isinstance(detailed_offers, list) and detailed_offers:
@@ -260,12 +502,16 @@ def test_woot_api():
             logging.error(f"Response: {response.text}")
             return False
     except Exception as e:
-        logging.error(f"Error testing Woot API: {e}")
-        logging.error(traceback.format_exc())
+        logging.exception(f"Error testing Woot API: {e}")
         return False
 
 def test_email():
     """Test email functionality."""
+    # Imported here so runs that don't send email skip the import cost on cold start
+    import smtplib
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    
     logging.info("=== TESTING EMAIL FUNCTIONALITY ===")
     
     if not GMAIL_USER or not GMAIL_APP_PASSWORD or not EMAIL_RECIPIENT:
@@ -277,7 +523,7 @@ def test_email():
         msg = MIMEMultipart('alternative')
         msg['Subject'] = f"Test Email from Woot Deals Service ({datetime.now().isoformat()})"
         msg['From'] = GMAIL_USER
-        msg['To'] = EMAIL_RECIPIENT
+        msg['To'] = ", ".join(EMAIL_RECIPIENTS)
         
         text_content = "This is a test email to verify the email functionality of the Woot Deals service."
         html_content = f"""
@@ -301,18 +547,12 @@ def test_email():
         # Send the email
         logging.info(f"Attempting to send test email from {GMAIL_USER} to {EMAIL_RECIPIENT}")
         
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
+        with smtp_lock:
             try:
-                logging.info("Connecting to SMTP server...")
-                server.ehlo()
-                logging.info("SMTP server connected")
-                
-                logging.info("Attempting login...")
-                server.login(GMAIL_USER, GMAIL_APP_PASSWORD)
-                logging.info("Login successful")
+                server = get_smtp_connection()
                 
                 logging.info("Sending email...")
-                server.send_message(msg)
+                server.send_message(msg, to_addrs=EMAIL_RECIPIENTS)
                 logging.info("Test email sent successfully")
                 return True
             except smtplib.SMTPAuthenticationError as e:
@@ -322,301 +562,547 @@ def test_email():
                 logging.error("App Passwords must be generated from your Google Account security settings")
                 return False
             except Exception as e:
-                logging.error(f"SMTP Error: {e}")
-                logging.error(traceback.format_exc())
+                logging.exception(f"SMTP Error: {e}")
+                # Don't hand a possibly broken connection to the next sender
+                close_smtp_connection()
                 return False
     except Exception as e:
-        logging.error(f"Error testing email functionality: {e}")
-        logging.error(traceback.format_exc())
+        logging.exception(f"Error testing email functionality: {e}")
         return False
 
+def parse_seen_deals(content):
+    """
+    Parse stored seen deals into a dict of deal ID to the time it was last seen in the feed.
+    Accepts gzipped or plain "<id>\t<timestamp>" lines, bare IDs, or a legacy JSON list;
+    deals without a timestamp are treated as seen now.
+    """
+    if content[:2] == b"\x1f\x8b":
+        content = gzip.decompress(content)
+    text = content.decode("utf-8")
+    now = int(time.time())
+    
+    if text.lstrip().startswith("["):
+        # Legacy format: a single JSON array of IDs
+        return dict.fromkeys(orjson.loads(text), now)
+    
+    seen_deals = {}
+    for line in text.splitlines():
+        if not line:
+            continue
+        deal_id, _, last_seen = line.partition("\t")
+        seen_deals[deal_id] = int(last_seen) if last_seen else now
+    return seen_deals
+
 def load_seen_deals():
-    """Load seen deals from Cloud Storage."""
+    """
+    Load seen deals from Cloud Storage as a dict of deal ID to the time it was last seen in the feed.
+    Falls back to the legacy uncompressed file the first time, before anything has been saved.
+    The file is downloaded conditionally, so nothing but a 304 comes back when it is
+    unchanged since the last load or save.
+    
+    Returns (seen_deals, generation), where generation is the stored file's generation to pass
+    back to save_seen_deals: "0" if it doesn't exist yet, or None if it couldn't be read.
+    """
     logging.info("Attempting to load seen deals from Cloud Storage")
     try:
-        if not storage_client:
-            logging.error("Storage client not initialized")
-            return []
-            
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(SEEN_DEALS_FILENAME)
+        if not BUCKET_NAME:
+            logging.error("BUCKET_NAME is not set")
+            return {}, None
         
-        if not blob.exists():
-            logging.info(f"Seen deals file '{SEEN_DEALS_FILENAME}' does not exist in bucket '{BUCKET_NAME}'. Returning empty list.")
-            return []
-            
-        seen_deals_content = blob.download_as_text()
-        seen_deals = json.loads(seen_deals_content)
-        logging.info(f"Loaded {len(seen_deals)} seen deals from Cloud Storage")
-        return seen_deals
+        # One conditional download: 304 if the cached generation is still current
+        content, generation = download_gcs_object_if_changed(SEEN_DEALS_FILENAME, seen_deals_cache["generation"])
+        if generation is not None and content is None:
+            logging.info(f"Seen deals file unchanged (generation {generation}). Using cached copy.")
+            # Return a copy so callers can add to it without touching the cache
+            return dict(seen_deals_cache["seen_deals"]), generation
+        
+        if generation is not None:
+            seen_deals = parse_seen_deals(content)
+            logging.info(f"Loaded {len(seen_deals)} seen deals from '{SEEN_DEALS_FILENAME}' in Cloud Storage")
+            seen_deals_cache["generation"] = generation
+            seen_deals_cache["seen_deals"] = dict(seen_deals)
+            return seen_deals, generation
+        
+        # The new file hasn't been written yet, so fall back to the legacy one.
+        # Either way the first save creates the new file, at generation "0".
+        content, _ = download_gcs_object_if_changed(LEGACY_SEEN_DEALS_FILENAME)
+        if content is None:
+            logging.info(f"Seen deals file '{SEEN_DEALS_FILENAME}' does not exist in bucket '{BUCKET_NAME}'. Returning no seen deals.")
+            return {}, "0"
+        
+        seen_deals = parse_seen_deals(content)
+        logging.info(f"Loaded {len(seen_deals)} seen deals from '{LEGACY_SEEN_DEALS_FILENAME}' in Cloud Storage")
+        return seen_deals, "0"
     except Exception as e:
-        logging.error(f"Error loading seen deals: {e}")
-        logging.error(traceback.format_exc())
-        return []
+        logging.exception(f"Error loading seen deals: {e}")
+        return {}, None
 
-def save_seen_deals(seen_deals):
-    """Save seen deals to Cloud Storage."""
+def save_seen_deals(seen_deals, generation=None):
+    """
+    Save seen deals to Cloud Storage as gzipped "<id>\t<timestamp>" lines, one per deal.
+    With the generation returned by load_seen_deals, the write only goes through if no other
+    run has saved since; otherwise that run's deals are merged in and the write is retried once.
+    """
     logging.info(f"Attempting to save {len(seen_deals)} seen deals to Cloud Storage")
     try:
-        if not storage_client:
-            logging.error("Storage client not initialized")
+        if not BUCKET_NAME:
+            logging.error("BUCKET_NAME is not set")
             return False
-            
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(SEEN_DEALS_FILENAME)
-        blob.upload_from_string(json.dumps(seen_deals))
+        
+        for attempt in range(2):
+            content = "\n".join(f"{deal_id}\t{last_seen}" for deal_id, last_seen in seen_deals.items())
+            try:
+                metadata = upload_gcs_object(
+                    SEEN_DEALS_FILENAME,
+                    gzip.compress(content.encode("utf-8")),
+                    content_type="application/gzip",
+                    if_generation_match=generation
+                )
+                break
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 412 or attempt:
+                    raise
+                
+                logging.warning("Seen deals file was updated by another run. Merging and retrying.")
+                latest_deals, generation = load_seen_deals()
+                if generation is None:
+                    logging.error("Could not reload seen deals to merge. Not saving.")
+                    return False
+                for deal_id, last_seen in latest_deals.items():
+                    seen_deals[deal_id] = max(seen_deals.get(deal_id, 0), last_seen)
+        
         logging.info(f"Saved {len(seen_deals)} seen deals to Cloud Storage")
+        
+        # Remember the generation just written so the next load can skip the download
+        seen_deals_cache["generation"] = metadata["generation"]
+        seen_deals_cache["seen_deals"] = {str(deal_id): last_seen for deal_id, last_seen in seen_deals.items()}
         return True
     except Exception as e:
-        logging.error(f"Error saving seen deals: {e}")
-        logging.error(traceback.format_exc())
+        logging.exception(f"Error saving seen deals: {e}")
         return False
 
-def fetch_feed():
-    """Fetch the feed from the Woot API with pagination support."""
-    logging.info("Fetching feed from Woot API")
-    headers = {
-        "x-api-key": WOOT_API_KEY,
-        "Accept": "application/json"
+def mark_deals_seen(seen_deals, deal_ids):
+    """Add deal IDs to seen_deals as seen now, leaving any already there untouched."""
+    now = int(time.time())
+    for deal_id in deal_ids:
+        seen_deals.setdefault(deal_id, now)
+
+def refresh_seen_deals(seen_deals, active_ids):
+    """
+    Update the last-seen time of seen deals that are still in the feed, once it is
+    more than SEEN_DEALS_REFRESH_INTERVAL old. Returns the number of deals refreshed.
+    """
+    now = int(time.time())
+    cutoff = now - SEEN_DEALS_REFRESH_INTERVAL
+    stale = [deal_id for deal_id in active_ids if seen_deals.get(deal_id, now) < cutoff]
+    for deal_id in stale:
+        seen_deals[deal_id] = now
+    return len(stale)
+
+def prune_seen_deals(seen_deals, active_ids):
+    """
+    Drop seen deals that haven't been in the feed for SEEN_DEALS_MAX_AGE.
+    Deals still in the feed are kept however long they've been listed, so they're never
+    re-notified; only call this with the IDs of a complete feed.
+    """
+    cutoff = int(time.time()) - SEEN_DEALS_MAX_AGE
+    expired = [deal_id for deal_id, last_seen in seen_deals.items()
+               if last_seen < cutoff and deal_id not in active_ids]
+    for deal_id in expired:
+        del seen_deals[deal_id]
+    if expired:
+        logging.info(f"Pruned {len(expired)} expired seen deals")
+    return len(expired)
+
+def get_offer_id(item):
+    """
+    Return the ID of a feed item or detailed offer, preferring OfferId and
+    falling back to Id. Returns None if neither is set.
+    """
+    return item.get("OfferId") or item.get("Id")
+
+def pause_woot_requests(seconds):
+    """Hold back every Woot API request, from any thread, for at least the given number of seconds."""
+    with woot_rate_limit_lock:
+        woot_rate_limit["paused_until"] = max(woot_rate_limit["paused_until"], time.monotonic() + seconds)
+
+def wait_for_woot_rate_limit():
+    """
+    Block until another Woot API request is allowed: after any pause set by
+    pause_woot_requests and, when WOOT_REQUESTS_PER_MINUTE is set, once the
+    token bucket has a token. Each caller reserves its token under the lock
+    and sleeps outside it, so concurrent batches queue up at the configured rate.
+    """
+    with woot_rate_limit_lock:
+        now = time.monotonic()
+        wait = woot_rate_limit["paused_until"] - now
+        if WOOT_REQUESTS_PER_MINUTE:
+            refill = (now - woot_rate_limit["updated_at"]) * WOOT_REQUESTS_PER_MINUTE / 60
+            woot_rate_limit["tokens"] = min(WOOT_RATE_LIMIT_BURST, woot_rate_limit["tokens"] + refill) - 1
+            woot_rate_limit["updated_at"] = now
+            wait = max(wait, -woot_rate_limit["tokens"] * 60 / WOOT_REQUESTS_PER_MINUTE)
+    
+    if wait > 0:
+        logging.info(f"Woot API rate limit reached. Waiting {wait:.2f} seconds...")
+        time.sleep(wait)
+
+def woot_request(method, url, headers=WOOT_HEADERS, **kwargs):
+    """
+    Make a request to the Woot API on the shared session, within the optional rate limit.
+    Requests with a JSON body should pass headers=WOOT_JSON_HEADERS.
+    """
+    wait_for_woot_rate_limit()
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    return SESSION.request(method, url, headers=headers, **kwargs)
+
+def fetch_feed_page(page_num):
+    """
+    Fetch and normalize one page of the feed.
+    Returns (items, total_pages), or None if the API returned an error.
+    Pages fetched on an earlier warm invocation are reused as-is within
+    FEED_CACHE_TTL seconds. Older ones are revalidated with conditional requests,
+    and reused without re-parsing when the API answers 304 Not Modified or returns
+    a body identical to the cached one.
+    """
+    # Add page parameter for pagination
+    page_url = f"{FEED_ENDPOINT}?page={page_num}"
+    logging.info(f"Making request to page {page_num}: {page_url}")
+    
+    page_headers = WOOT_HEADERS
+    cached_page = feed_page_cache.get(page_url)
+    if cached_page and time.time() - cached_page["fetched_at"] < FEED_CACHE_TTL:
+        logging.info(f"Page {page_num} fetched recently. Using {len(cached_page['items'])} cached items.")
+        return cached_page["items"], cached_page["total_pages"]
+    if cached_page:
+        page_headers = dict(WOOT_HEADERS)
+        if cached_page["etag"]:
+            page_headers["If-None-Match"] = cached_page["etag"]
+        if cached_page["last_modified"]:
+            page_headers["If-Modified-Since"] = cached_page["last_modified"]
+    
+    response = woot_request("GET", page_url, headers=page_headers)
+    logging.info(f"Received response for page {page_num} with status code: {response.status_code}")
+    
+    body_digest = None
+    if response.status_code == 200:
+        # Not every server honors conditional headers, and an identical
+        # body is just as reusable as a 304
+        body_digest = hashlib.sha1(response.content).digest()
+    
+    if cached_page and (response.status_code == 304 or body_digest == cached_page["digest"]):
+        logging.info(f"Page {page_num} not modified. Using {len(cached_page['items'])} cached items.")
+        cached_page["fetched_at"] = time.time()
+        return cached_page["items"], cached_page["total_pages"]
+    
+    if response.status_code != 200:
+        logging.error(f"Error response: {response.text}")
+        # Don't keep serving a page the API is now failing on
+        feed_page_cache.pop(page_url, None)
+        return None
+        
+    response.raise_for_status()
+    # Parse the raw bytes with orjson; it's much faster than the stdlib
+    # on the large feed payloads and skips requests' encoding detection
+    api_response = orjson.loads(response.content)
+    
+    # Extract and normalize items from this page
+    total_pages = 1
+    page_items = []
+    
+    if isinstance(api_response, dict):
+        # Update total pages if available in response
+        if "TotalPages" in api_response:
+            total_pages = api_response["TotalPages"]
+        
+        item_list = None
+        if "Items" in api_response and isinstance(api_response["Items"], list):
+            item_list = api_response["Items"]
+            logging.info(f"Found {len(item_list)} items on page {page_num}")
+        
+        # Process items from this page
+        if item_list:
+            for item in item_list:
+                if isinstance(item, dict):
+                    # Keep only the fields the prefilter reads; everything
+                    # else comes from getoffers for the few items that match
+                    processed_item = {field: item[field] for field in PREFILTER_FIELDS if field in item}
+                    
+                    # Make sure we have a consistent ID field, using OfferId
+                    # as the primary ID and falling back to Id if needed
+                    offer_id = get_offer_id(item)
+                    if offer_id:
+                        processed_item["Id"] = processed_item["OfferId"] = offer_id
+                        
+                    page_items.append(processed_item)
+    
+    # Remember the page so the next invocation can revalidate it
+    feed_page_cache[page_url] = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "digest": body_digest,
+        "total_pages": total_pages,
+        "items": page_items,
+        "fetched_at": time.time()
     }
+    return page_items, total_pages
+
+def fetch_feed():
+    """
+    Fetch the feed from the Woot API with pagination support.
+    The first page gives the page count; the rest are then fetched in parallel,
+    at most MAX_CONCURRENT_BATCHES at a time since they share the API key's rate limit.
     
-    all_items = []
-    current_page = 1
-    total_pages = 1  # Initialize to at least 1 page
+    Returns (items, complete), where complete is False if any page couldn't be fetched.
+    """
+    logging.info("Fetching feed from Woot API")
     
     try:
-        while current_page <= total_pages:
-            # Add page parameter for pagination
-            page_url = f"{FEED_ENDPOINT}?page={current_page}"
-            logging.info(f"Making request to page {current_page} of {total_pages}: {page_url}")
-            response = requests.get(page_url, headers=headers)
-            logging.info(f"Received response with status code: {response.status_code}")
-            
-            if response.status_code != 200:
-                logging.error(f"Error response: {response.text}")
-                break
-                
-            response.raise_for_status()
-            api_response = response.json()
-            
-            # Update total pages if available in response
-            if isinstance(api_response, dict) and "TotalPages" in api_response:
-                total_pages = max(total_pages, api_response["TotalPages"])
-                logging.info(f"Updated total pages to {total_pages}")
-            
-            # Extract and normalize items from this page
-            page_items = []
-            
-            if isinstance(api_response, dict):
-                item_list = None
-                if "Items" in api_response and isinstance(api_response["Items"], list):
-                    item_list = api_response["Items"]
-                    logging.info(f"Found {len(item_list)} items on page {current_page}")
-                
-                # Process items from this page
-                if item_list:
-                    for item in item_list:
-                        if isinstance(item, dict):
-                            # Make sure we have a consistent ID field
-                            processed_item = item.copy()
-                            
-                            # Use OfferId as the primary ID, falling back to Id if needed
-                            if "OfferId" in item:
-                                processed_item["Id"] = item["OfferId"]
-                            elif "Id" in item:
-                                processed_item["OfferId"] = item["Id"]
-                                
-                            page_items.append(processed_item)
-                
-                # Add items from this page to our total
-                all_items.extend(page_items)
-            
-            # Move to the next page
-            current_page += 1
+        first_page = fetch_feed_page(1)
+        if first_page is None:
+            return [], False
+        
+        all_items = list(first_page[0])
+        total_pages = first_page[1]
+        logging.info(f"Feed has {total_pages} pages")
+        
+        if total_pages > 1:
+            with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_BATCHES, total_pages - 1)) as executor:
+                # map yields pages in order, so stopping at the first failed page
+                # keeps everything before it, as the serial loop did
+                for page_num, page in enumerate(executor.map(fetch_feed_page, range(2, total_pages + 1)), start=2):
+                    if page is None:
+                        logging.warning(f"Stopped at page {page_num} of {total_pages}; the feed is incomplete")
+                        return all_items, False
+                    all_items.extend(page[0])
         
         logging.info(f"Fetched a total of {len(all_items)} items from all {total_pages} pages")
-        return all_items
+        return all_items, True
     except Exception as e:
-        logging.error(f"Error fetching feed: {e}")
-        logging.error(traceback.format_exc())
-        return []
+        logging.exception(f"Error fetching feed: {e}")
+        return [], False
 
-def fetch_detailed_offers(offer_ids):
+def adjust_offers_batch_size(rate_limited):
+    """Grow the getoffers batch size by one after a successful batch, or halve it after a 429."""
+    with offers_batch_size_lock:
+        old_size = offers_batch_size["size"]
+        if rate_limited:
+            offers_batch_size["size"] = max(MIN_OFFERS_BATCH_SIZE, old_size // 2)
+        else:
+            offers_batch_size["size"] = min(MAX_OFFERS_BATCH_SIZE, old_size + 1)
+        new_size = offers_batch_size["size"]
+    if rate_limited and new_size != old_size:
+        logging.info(f"Reduced getoffers batch size from {old_size} to {new_size}")
+
+def fetch_offer_batch(batch, batch_num, pending, pending_lock):
     """
-    Fetch detailed information for the specified offer IDs with retry logic.
-    Handles rate limiting with exponential backoff.
+    Fetch detailed information for a single batch of offer IDs.
+    Handles rate limiting with exponential backoff and returns the offers fetched.
+    After a 429, IDs beyond the reduced batch size go back on pending for a later batch.
     """
-    if not offer_ids:
-        logging.info("No offer IDs provided. Skipping detailed offers fetch.")
-        return []
-    
-    batch_size = 10  # Reduced from 25 to avoid rate limits
-    all_detailed_offers = []
+    logging.info(f"Fetching details for batch {batch_num} with {len(batch)} offer IDs")
     
-    # Process in smaller batches with delays between them
-    for i in range(0, len(offer_ids), batch_size):
-        batch = offer_ids[i:i+batch_size]
-        logging.info(f"Fetching details for batch {i//batch_size + 1}/{(len(offer_ids)+batch_size-1)//batch_size} with {len(batch)} offer IDs")
-        
-        headers = {
-            "x-api-key": WOOT_API_KEY,
-            "Accept": "application/json",
-            "Content-Type": "application/json"
-        }
-        
-        # Add random jitter to delay to prevent synchronized requests
+    # Batches after the first wave wait before starting, with random jitter
+    # to prevent synchronized requests. The token bucket paces them instead
+    # when WOOT_REQUESTS_PER_MINUTE is set.
+    if batch_num > MAX_CONCURRENT_BATCHES and not WOOT_REQUESTS_PER_MINUTE:
         delay_with_jitter = BASE_DELAY_BETWEEN_BATCHES + random.uniform(0.5, 2.0)
-        
-        # Wait before making a request (except for the first batch)
-        if i > 0:
-            logging.info(f"Waiting {delay_with_jitter:.2f} seconds before next batch...")
-            time.sleep(delay_with_jitter)
-        
-        retry_count = 0
-        retry_delay = INITIAL_RETRY_DELAY
-        
-        while retry_count <= MAX_RETRIES:
-            try:
-                logging.info(f"Making request to {GETOFFERS_ENDPOINT}")
-                logging.info(f"Request data: {json.dumps(batch)}")
+        logging.info(f"Waiting {delay_with_jitter:.2f} seconds before batch {batch_num}...")
+        time.sleep(delay_with_jitter)
+    
+    # Encode the request body once; retries resend the same bytes
+    request_data = orjson.dumps(batch)
+    
+    retry_count = 0
+    retry_delay = INITIAL_RETRY_DELAY
+    
+    while retry_count <= MAX_RETRIES:
+        try:
+            logging.info(f"Making request to {GETOFFERS_ENDPOINT}")
+            logging.info(f"Request data: {request_data.decode('utf-8')}")
+            
+            response = woot_request(
+                "POST",
+                GETOFFERS_ENDPOINT,
+                headers=WOOT_JSON_HEADERS, 
+                data=request_data
+            )
+            
+            logging.info(f"Received response with status code: {response.status_code}")
+            
+            # Success case
+            if response.status_code == 200:
+                detailed_offers = orjson.loads(response.content)
                 
-                response = requests.post(
-                    GETOFFERS_ENDPOINT, 
-                    headers=headers, 
-                    data=json.dumps(batch)
-                )
+                if isinstance(detailed_offers, list):
+                    logging.info(f"Fetched {len(detailed_offers)} detailed offers from the API.")
+                    adjust_offers_batch_size(rate_limited=False)
+                    return detailed_offers
                 
-                logging.info(f"Received response with status code: {response.status_code}")
+                logging.warning(f"Detailed offers response is not a list: {type(detailed_offers)}")
+                return []
                 
-                # Success case
-                if response.status_code == 200:
-                    detailed_offers = response.json()
-                    
-                    if isinstance(detailed_offers, list):
-                        logging.info(f"Fetched {len(detailed_offers)} detailed offers from the API.")
-                        all_detailed_offers.extend(detailed_offers)
-                    else:
-                        logging.warning(f"Detailed offers response is not a list: {type(detailed_offers)}")
-                    
-                    # Success, exit the retry loop
-                    break
+            # Rate limiting case
+            elif response.status_code == 429:
+                retry_count += 1
+                adjust_offers_batch_size(rate_limited=True)
+                
+                if retry_count <= MAX_RETRIES:
+                    # Retry with no more than the reduced batch size; the rest
+                    # go back in the queue so the next batch picks them up
+                    batch_size = offers_batch_size["size"]
+                    if len(batch) > batch_size:
+                        with pending_lock:
+                            pending.extend(batch[batch_size:])
+                        batch = batch[:batch_size]
+                        request_data = orjson.dumps(batch)
+                        logging.info(f"Split batch {batch_num}; retrying with {len(batch)} offer IDs")
                     
-                # Rate limiting case
-                elif response.status_code == 429:
-                    retry_count += 1
+                    # Wait at least as long as the API asks, when it says
+                    retry_after = response.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        retry_delay = max(retry_delay, int(retry_after))
+                    logging.warning(f"Rate limited (429). Retry {retry_count}/{MAX_RETRIES}. Waiting {retry_delay} seconds...")
+                    # Back the other in-flight batches off too, rather than
+                    # letting them run into the same limit
+                    pause_woot_requests(retry_delay)
+                    time.sleep(retry_delay)
                     
-                    if retry_count <= MAX_RETRIES:
-                        logging.warning(f"Rate limited (429). Retry {retry_count}/{MAX_RETRIES}. Waiting {retry_delay} seconds...")
-                        time.sleep(retry_delay)
-                        
-                        # Exponential backoff with jitter
-                        retry_delay = min(MAX_RETRY_DELAY, retry_delay * 2) + random.uniform(0, 1)
-                    else:
-                        logging.error(f"Max retries reached for batch. Moving to next batch.")
-                        break
-                
-                # Other error cases
+                    # Exponential backoff with jitter
+                    retry_delay = min(MAX_RETRY_DELAY, retry_delay * 2) + random.uniform(0, 1)
                 else:
-                    logging.error(f"Error response: {response.text}")
-                    retry_count += 1
-                    
-                    if retry_count <= MAX_RETRIES:
-                        logging.warning(f"Error {response.status_code}. Retry {retry_count}/{MAX_RETRIES}. Waiting {retry_delay} seconds...")
-                        time.sleep(retry_delay)
-                        
-                        # Exponential backoff with jitter
-                        retry_delay = min(MAX_RETRY_DELAY, retry_delay * 2) + random.uniform(0, 1)
-                    else:
-                        logging.error(f"Max retries reached for batch. Moving to next batch.")
-                        break
-                        
-            except Exception as e:
-                logging.error(f"Error fetching detailed offers batch: {e}")
-                logging.error(traceback.format_exc())
-                
+                    logging.error(f"Max retries reached for batch {batch_num}. Moving to next batch.")
+            
+            # Other error cases
+            else:
+                logging.error(f"Error response: {response.text}")
                 retry_count += 1
+                
                 if retry_count <= MAX_RETRIES:
-                    logging.warning(f"Exception occurred. Retry {retry_count}/{MAX_RETRIES}. Waiting {retry_delay} seconds...")
+                    logging.warning(f"Error {response.status_code}. Retry {retry_count}/{MAX_RETRIES}. Waiting {retry_delay} seconds...")
                     time.sleep(retry_delay)
                     
                     # Exponential backoff with jitter
                     retry_delay = min(MAX_RETRY_DELAY, retry_delay * 2) + random.uniform(0, 1)
                 else:
-                    logging.error(f"Max retries reached for batch. Moving to next batch.")
-                    break
+                    logging.error(f"Max retries reached for batch {batch_num}. Moving to next batch.")
+                    
+        except Exception as e:
+            logging.exception(f"Error fetching detailed offers batch: {e}")
+            
+            retry_count += 1
+            if retry_count <= MAX_RETRIES:
+                logging.warning(f"Exception occurred. Retry {retry_count}/{MAX_RETRIES}. Waiting {retry_delay} seconds...")
+                time.sleep(retry_delay)
+                
+                # Exponential backoff with jitter
+                retry_delay = min(MAX_RETRY_DELAY, retry_delay * 2) + random.uniform(0, 1)
+            else:
+                logging.error(f"Max retries reached for batch {batch_num}. Moving to next batch.")
+    
+    return []
+
+def fetch_offer_batches(pending, pending_lock, batch_numbers):
+    """
+    Take batches of offer IDs off pending and fetch them until none are left.
+    Each batch is sliced at the batch size current when it's taken, so a 429
+    shrinks the very next batch. Returns the offers fetched.
+    """
+    detailed_offers = []
+    while True:
+        with pending_lock:
+            if not pending:
+                return detailed_offers
+            batch = [pending.popleft() for _ in range(min(offers_batch_size["size"], len(pending)))]
+            batch_num = next(batch_numbers)
+        detailed_offers.extend(fetch_offer_batch(batch, batch_num, pending, pending_lock))
+
+def fetch_detailed_offers(offer_ids):
+    """
+    Fetch detailed information for all of the specified offer IDs.
+    The IDs are queued and taken off in batches by a few workers in parallel,
+    each batch with its own retry logic.
+    """
+    if not offer_ids:
+        logging.info("No offer IDs provided. Skipping detailed offers fetch.")
+        return []
+    
+    # An offer listed on more than one feed page only needs fetching once
+    offer_ids = list(dict.fromkeys(offer_ids))
+    
+    # Workers slice each batch as they take it, so batch size changes after a
+    # success or a 429 apply within this run rather than only to the next one
+    pending = deque(offer_ids)
+    pending_lock = threading.Lock()
+    batch_numbers = itertools.count(1)
+    batch_size = offers_batch_size["size"]
+    worker_count = min(MAX_CONCURRENT_BATCHES, -(-len(offer_ids) // batch_size))
+    logging.info(f"Fetching details for {len(offer_ids)} offer IDs in batches starting at {batch_size}")
+    
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        workers = [executor.submit(fetch_offer_batches, pending, pending_lock, batch_numbers)
+                   for _ in range(worker_count)]
+        all_detailed_offers = list(itertools.chain.from_iterable(worker.result() for worker in workers))
     
     logging.info(f"Total detailed offers fetched: {len(all_detailed_offers)}")
     return all_detailed_offers
 
+def deal_text(deal):
+    """
+    Join a detailed offer's title, writeup, features, subtitle and snippet into one
+    string for keyword searches. Fields are separated by newlines so a keyword can't
+    span two fields; missing or null fields count as empty.
+    """
+    return "\n".join(deal.get(field) or "" for field in DEAL_TEXT_FIELDS)
+
 def is_matching_deal(deal):
     """Check if a deal matches our keywords."""
-    # Use either Id or OfferId, whichever is available
-    deal_id = deal.get("Id", deal.get("OfferId", "unknown"))
-    logging.info(f"Checking if deal {deal_id} matches keywords")
-    
-    # Check title
-    title = deal.get("Title", "") or ""
-    if any(keyword.lower() in title.lower() for keyword in KEYWORDS):
-        logging.info(f"Deal {deal_id} matches keywords in title: {title}")
+    # Search all of the deal's text fields in a single pass
+    match = KEYWORD_RE.search(deal_text(deal))
+    if match:
+        logging.info(f"Deal {get_offer_id(deal) or 'unknown'} matches keyword '{match.group(0)}': {deal.get('Title', '')}")
         return True
     
-    # Check description/writeup
-    writeup = deal.get("WriteUpBody", "") or ""
-    if any(keyword.lower() in writeup.lower() for keyword in KEYWORDS):
-        logging.info(f"Deal {deal_id} matches keywords in writeup")
-        return True
-    
-    # Check features
-    features = deal.get("Features", "") or ""
-    if any(keyword.lower() in features.lower() for keyword in KEYWORDS):
-        logging.info(f"Deal {deal_id} matches keywords in features")
-        return True
-        
-    # Check subtitle if available
-    subtitle = deal.get("Subtitle", "") or ""
-    if any(keyword.lower() in subtitle.lower() for keyword in KEYWORDS):
-        logging.info(f"Deal {deal_id} matches keywords in subtitle")
-        return True
-    
-    # Check snippet if available
-    snippet = deal.get("Snippet", "") or ""
-    if any(keyword.lower() in snippet.lower() for keyword in KEYWORDS):
-        logging.info(f"Deal {deal_id} matches keywords in snippet")
-        return True
-        
-    logging.info(f"Deal {deal_id} does not match any keywords")
+    # Per-deal misses are only worth formatting when debugging
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Deal {get_offer_id(deal) or 'unknown'} does not match any keywords")
     return False
 
 def filter_deals(deals, seen_deals):
-    """Filter deals that match our keywords and haven't been seen before."""
+    """
+    Filter deals that match our keywords and haven't been seen before.
+    seen_deals is the dict returned by load_seen_deals, so each lookup is O(1).
+    """
     logging.info(f"Filtering {len(deals)} deals against {len(seen_deals)} seen deals")
     new_matching_deals = []
+    checked_ids = set()  # Deals already classified in this call
     
     for deal in deals:
-        # Try both Id and OfferId fields for compatibility
-        unique_id = deal.get("Id", deal.get("OfferId"))
+        unique_id = get_offer_id(deal)
         if not unique_id:
-            logging.warning(f"Deal has no Id or OfferId: {json.dumps({k: v for k, v in deal.items() if k in ['Title', 'Url']}, indent=2)}")
+            logging.warning(f"Deal has no Id or OfferId: {orjson.dumps({k: v for k, v in deal.items() if k in ['Title', 'Url']}).decode('utf-8')}")
             continue
             
-        if unique_id in seen_deals:
-            logging.info(f"Deal {unique_id} has been seen before, skipping")
+        # Skip seen deals, and scan an offer that comes back more than once
+        # only the first time. Both are counted in the summary below.
+        if unique_id in seen_deals or unique_id in checked_ids:
             continue
-            
+        checked_ids.add(unique_id)
+        
+        # is_matching_deal logs each match
         if is_matching_deal(deal):
-            logging.info(f"Found new matching deal: {unique_id}")
             new_matching_deals.append(deal)
             
-    logging.info(f"Found {len(new_matching_deals)} new matching deals.")
+    logging.info(f"Found {len(new_matching_deals)} new matching deals among {len(checked_ids)} new deals checked.")
     return new_matching_deals
 
 def format_deal_notifications(deal):
     """Format a deal for both email and text notifications."""
-    deal_id = deal.get("Id", deal.get("OfferId", "unknown"))
+    deal_id = get_offer_id(deal) or "unknown"
     logging.info(f"Formatting notifications for deal {deal_id}")
     
-    title = deal.get("Title", "No Title")
-    url = deal.get("Url", "No URL")
+    # The API can send null rather than leaving a field out, so fall back on either
+    title = deal.get("Title") or "No Title"
+    url = deal.get("Url") or "No URL"
     
     # Get price information - handle different possible structures
     sale_price = None
@@ -666,23 +1152,29 @@ def format_deal_notifications(deal):
             max_title_len = 10
         text_message = f"{title[:max_title_len]}... {price_info}{list_price_text}"
     
-    # 2. Format the detailed email
-    email_body = f"""
-<h2>{title}</h2>
-<p><strong>Price:</strong> {price_info}{savings_info}</p>
-<p><strong>URL:</strong> <a href="{url}">{url}</a></p>
-<hr>
-<p><small>Sent by your Woot Deals alert system</small></p>
-"""
+    # 2. Format the detailed email. Titles and URLs come from the API, so
+    # escape them rather than inserting raw markup into the HTML.
+    email_body = DEAL_EMAIL_TEMPLATE.format(
+        title=html.escape(title),
+        price=html.escape(f"{price_info}{savings_info}"),
+        url=html.escape(url)
+    )
     
     logging.info(f"Notifications formatted for deal {deal_id}")
     return title, email_body, text_message
 
 def send_notifications(deals):
-    """Send email and text notifications for new deals."""
+    """
+    Send email and text notifications for new deals.
+    Returns True if both messages were sent (or there was nothing to send), False otherwise.
+    """
     if not deals:
         logging.info("No deals to send notifications for. Skipping.")
-        return
+        return True
+    
+    # Imported here so runs without new deals skip the import cost on cold start
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
         
     logging.info(f"Preparing to send notifications for {len(deals)} deals")
     try:
@@ -690,7 +1182,7 @@ def send_notifications(deals):
         text_msg = MIMEMultipart('alternative')
         text_msg['Subject'] = f"Woot Deal Alert"
         text_msg['From'] = GMAIL_USER
-        text_msg['To'] = EMAIL_RECIPIENT  # This is the phone number email
+        text_msg['To'] = ", ".join(EMAIL_RECIPIENTS)  # This is the phone number email
         
         # Send detailed emails to the sender's address
         email_msg = MIMEMultipart('alternative')
@@ -698,27 +1190,24 @@ def send_notifications(deals):
         email_msg['From'] = GMAIL_USER
         email_msg['To'] = GMAIL_USER  # Send to yourself
         
+        # Collect each deal's plain text and HTML in one pass; the HTML list
+        # starts and ends with the document wrapper so it's joined only once
         text_parts = []
-        html_parts = []
-        sms_parts = []
+        html_parts = ["<html><body>"]
         
         for deal in deals:
-            title, html_content, sms_content = format_deal_notifications(deal)
-            text_parts.append(f"{title} - {deal.get('Url', 'No URL')}")
-            html_parts.append(html_content)
-            sms_parts.append(sms_content)
+            title, deal_html, _ = format_deal_notifications(deal)
+            text_parts.append(f"{title} - {deal.get('Url') or 'No URL'}")
+            html_parts.append(deal_html)
+        
+        html_parts.append("</body></html>")
         
         # For SMS - use a simple summary format instead of listing each deal
         # Find which keywords matched
         matched_keywords = set()
         for deal in deals:
-            for keyword in KEYWORDS:
-                if (keyword.lower() in deal.get("Title", "").lower() or 
-                    keyword.lower() in deal.get("WriteUpBody", "").lower() or
-                    keyword.lower() in deal.get("Features", "").lower() or
-                    keyword.lower() in deal.get("Subtitle", "").lower() or
-                    keyword.lower() in deal.get("Snippet", "").lower()):
-                    matched_keywords.add(keyword)
+            # One pass of the compiled pattern finds every keyword in the deal
+            matched_keywords.update(match.lower() for match in KEYWORD_RE.findall(deal_text(deal)))
         
         # Create a comma-separated list of matched keywords
         keywords_str = ", ".join(matched_keywords)
@@ -733,39 +1222,51 @@ def send_notifications(deals):
         
         # For email - use full HTML
         text_content = "\n\n".join(text_parts)
-        html_content = "<html><body>" + "".join(html_parts) + "</body></html>"
+        html_content = "".join(html_parts)
         email_msg.attach(MIMEText(text_content, 'plain'))
         email_msg.attach(MIMEText(html_content, 'html'))
         
-        # Send both messages
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(GMAIL_USER, GMAIL_APP_PASSWORD)
-            
-            # Send text message first
-            server.send_message(text_msg)
-            logging.info("Text message sent successfully")
-            
-            # Send detailed email
-            server.send_message(email_msg)
-            logging.info("Email notification sent successfully")
+        # Send both messages over the shared connection
+        with smtp_lock:
+            try:
+                server = get_smtp_connection()
+                
+                # Send text message first, to every recipient in one transaction
+                server.send_message(text_msg, to_addrs=EMAIL_RECIPIENTS)
+                logging.info("Text message sent successfully")
+                
+                # Send detailed email
+                server.send_message(email_msg)
+                logging.info("Email notification sent successfully")
+            except Exception:
+                # Don't hand a possibly broken connection to the next sender
+                close_smtp_connection()
+                raise
             
         logging.info(f"Sent notifications for {len(deals)} deals")
+        return True
         
     except Exception as e:
-        logging.error(f"Error sending notifications: {e}")
-        logging.error(traceback.format_exc())
+        logging.exception(f"Error sending notifications: {e}")
+        return False
 
 def run_all_tests():
     """Run all diagnostic tests."""
     logging.info("====== RUNNING ALL DIAGNOSTIC TESTS ======")
     
-    results = {
-        "environment_variables": test_environment_variables(),
-        "storage_access": test_storage_access(),
-        "woot_api": test_woot_api(),
-        "email": test_email(),
-        "api_structure": test_woot_api_structure()  # Add our new test
+    # The environment check is local and fast; the rest are dominated by network
+    # I/O (GCS, Woot API, Gmail), so run them concurrently
+    results = {"environment_variables": test_environment_variables()}
+    network_tests = {
+        "storage_access": test_storage_access,
+        "woot_api": test_woot_api,
+        "email": test_email,
+        "api_structure": test_woot_api_structure  # Add our new test
     }
+    with ThreadPoolExecutor(max_workers=len(network_tests)) as executor:
+        futures = {test_name: executor.submit(test) for test_name, test in network_tests.items()}
+        for test_name, future in futures.items():
+            results[test_name] = future.result()
     
     logging.info("====== TEST RESULTS SUMMARY ======")
     all_passed = True
@@ -785,8 +1286,8 @@ def title_contains_keywords(title):
     if not title:
         return False
     
-    title_lower = title.lower()
-    return any(keyword.lower() in title_lower for keyword in KEYWORDS)
+    # One case-insensitive scan for all keywords, no lowercased copy of the title
+    return KEYWORD_RE.search(title) is not None
 
 def improved_title_contains_keywords(item):
     """
@@ -796,32 +1297,20 @@ def improved_title_contains_keywords(item):
     if not isinstance(item, dict):
         return False
     
-    # Check all these potential text fields
-    fields_to_check = [
-        "Title", "title",
-        "Description", "description",
-        "Subtitle", "subtitle",
-        "Snippet", "snippet", 
-        "Summary", "summary",
-        "Name", "name",
-        "ProductName", "productName",
-        "WriteUpBody", "writeUpBody",
-        "Features", "features"
-    ]
-    
-    # Get the item ID for logging
-    item_id = item.get("OfferId", item.get("Id", "unknown"))
-    
-    for field in fields_to_check:
-        value = item.get(field, "")
-        if value and isinstance(value, str):
-            value_lower = value.lower()
-            for keyword in KEYWORDS:
-                if keyword.lower() in value_lower:
-                    logging.info(f"✓ Found keyword '{keyword}' in field '{field}': '{value[:50]}...'")
-                    return True
+    # Join the item's text fields and search them with the compiled keyword
+    # pattern in one case-insensitive pass. Newline separators keep a keyword
+    # from spanning two fields.
+    text_fields = [field for field in PREFILTER_FIELDS if isinstance(item.get(field), str)]
+    match = KEYWORD_RE.search("\n".join(item[field] for field in text_fields))
+    if match:
+        # Hits are rare, so only now work out which field matched for the log
+        field = next(field for field in text_fields if KEYWORD_RE.search(item[field]))
+        logging.info(f"✓ Found keyword '{match.group(0).lower()}' in field '{field}': '{item[field][:50]}...'")
+        return True
     
-    logging.debug(f"No keywords found in any checked fields for item {item_id}")
+    # Most new items end up here, so only build the message when DEBUG is on
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"No keywords found in any checked fields for item {get_offer_id(item) or 'unknown'}")
     return False
 
 def check_woot_deals(request):
@@ -829,6 +1318,14 @@ def check_woot_deals(request):
     Main function to check for Woot deals.
     This function can be triggered by HTTP request or Cloud Scheduler.
     """
+    # Keep-alive pings from the warmup scheduler job only need the container
+    # (and its module-level clients) to stay loaded, so return right away
+    if request and hasattr(request, 'get_json'):
+        body = request.get_json(silent=True)
+        if isinstance(body, dict) and body.get('warmup'):
+            logging.info("Warmup request received. Skipping deals check.")
+            return "warm"
+    
     # Extract test mode from request if provided
     test_mode = None
     if request and hasattr(request, 'args') and request.args:
@@ -836,168 +1333,195 @@ def check_woot_deals(request):
     
     logging.info(f"====== STARTING WOOT DEALS CHECK {'(TEST MODE: ' + test_mode + ')' if test_mode else ''} ======")
     
-    # If a specific test is requested, run only that test
-    if test_mode:
-        if test_mode == "env":
-            test_environment_variables()
-            return "Environment variables test completed. Check logs for results."
-        elif test_mode == "storage":
-            test_storage_access()
-            return "Storage access test completed. Check logs for results."
-        elif test_mode == "api":
-            test_woot_api()
-            return "Woot API test completed. Check logs for results."
-        elif test_mode == "email":
-            test_email()
-            return "Email test completed. Check logs for results."
-        elif test_mode == "structure":  # Add new test option
-            test_woot_api_structure()
-            return "Woot API structure test completed. Check logs for results."
-        elif test_mode == "all":
-            run_all_tests()
-            return "All diagnostic tests completed. Check logs for results."
+    # If a specific test is requested, run only that test. Unknown modes fall
+    # through to a regular run.
+    if test_mode in TEST_MODES:
+        test_function, test_name = TEST_MODES[test_mode]
+        test_function()
+        return f"{test_name} completed. Check logs for results."
     
     # Regular operation
     logging.info("Starting regular operation")
     
-    # Log environment variables status
-    env_vars_set = test_environment_variables()
+    # Log environment variables status (once per container)
+    env_vars_set = required_env_vars_set()
     if not env_vars_set:
         logging.error("Missing required environment variables. Cannot proceed.")
         return "Error: Missing required environment variables"
     
-    # Load previously seen deal IDs
-    seen_deals = load_seen_deals()
+    # Load previously seen deal IDs and fetch the feed (step 1) concurrently,
+    # since the GCS read and the Woot request don't depend on each other
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        seen_deals_future = executor.submit(load_seen_deals)
+        feed_future = executor.submit(fetch_feed)
+        seen_deals, seen_deals_generation = seen_deals_future.result()
+        feed_items, feed_complete = feed_future.result()
+    
+    # Without the stored seen deals every live match would look new, and saving
+    # without a generation to match would overwrite the history, so stop here
+    if seen_deals_generation is None:
+        logging.error("Could not load seen deals. Not checking for new deals this run.")
+        return "Error: Could not load seen deals"
     
-    # Step 1: Fetch the feed to get basic deal information
-    feed_items = fetch_feed()
     if not feed_items:
         logging.info("No feed items found. Exiting.")
         return "No feed items found"
     
     # Step 2: Pre-filter feed items by checking multiple fields to reduce API calls
     potential_matches = []
-    all_offer_ids = []  # Track all offers for seen deals list
+    all_offer_ids = set()  # Every offer in the feed, for pruning seen deals
+    rejected_offer_ids = []  # New offers the prefilter ruled out
+    new_offer_count = 0  # Offers not yet in seen_deals
     
     logging.info(f"Pre-filtering {len(feed_items)} items from the feed")
     
     for item in feed_items:
         # Get the ID for tracking
-        offer_id = None
-        if "OfferId" in item:
-            offer_id = item["OfferId"]
-        elif "Id" in item:
-            offer_id = item["Id"]
-        
+        offer_id = get_offer_id(item)
         if not offer_id:
             continue
-            
-        # Add to all offers list
-        all_offer_ids.append(offer_id)
         
-        # Skip if already seen
+        # An offer listed on more than one page is only prefiltered once
+        if offer_id in all_offer_ids:
+            continue
+        all_offer_ids.add(offer_id)
+        
+        # Skip if already seen (counted in the summary below rather than logged
+        # one line per item, since most of the feed is seen on a typical run)
         if offer_id in seen_deals:
-            logging.info(f"Deal {offer_id} has been seen before, skipping")
             continue
         
+        new_offer_count += 1
+        
         # Use improved prefiltering that checks multiple fields
         if improved_title_contains_keywords(item):
             logging.info(f"Pre-filter match found for item {offer_id}")
             potential_matches.append(offer_id)
+        else:
+            rejected_offer_ids.append(offer_id)
     
-    logging.info(f"Pre-filtered {len(feed_items)} items down to {len(potential_matches)} potential matches")
+    logging.info(f"Pre-filtered {len(feed_items)} items: {len(all_offer_ids) - new_offer_count} already seen, "
+                 f"{len(potential_matches)} potential matches, {len(rejected_offer_ids)} ruled out")
     
-    # If no potential matches from expanded field screening, we're done
-    if not potential_matches:
-        # Add all offer IDs to seen deals to avoid checking them again
-        seen_deals.extend([id for id in all_offer_ids if id not in seen_deals])
-        save_seen_deals(seen_deals)
-        
-        logging.info("No potential matches found in pre-filtering. Exiting.")
-        return "No matching deals found."
+    # Keep the last-seen time of deals still in the feed current, and forget deals
+    # that have been gone for a long time so seen_deals doesn't grow forever. Deals
+    # on pages that failed to load aren't in all_offer_ids, so only prune when the
+    # whole feed came back.
+    dirty = refresh_seen_deals(seen_deals, all_offer_ids) > 0
+    if feed_complete:
+        dirty = prune_seen_deals(seen_deals, all_offer_ids) > 0 or dirty
+    else:
+        logging.warning("Feed is incomplete. Not pruning seen deals this run.")
     
-    # Step 3: Process potential matches with rate limiting awareness
-    all_matching_deals = []
-    batch_size = 10  # Smaller batch size to avoid rate limits
-    total_batches = (len(potential_matches) + batch_size - 1) // batch_size  # Ceiling division
-    processed_deal_ids = []  # NEW: Track all processed deals separately from seen_deals
+    # If every offer in the feed has been seen, there's nothing to look up and
+    # nothing new to record, so skip getoffers, and the GCS write unless
+    # last-seen times were refreshed or deals pruned
+    if not new_offer_count:
+        logging.info("All feed offers have been seen before. Exiting.")
+        if dirty:
+            save_seen_deals(seen_deals, seen_deals_generation)
+        return "No new offers in the feed."
     
-    logging.info(f"Processing {len(potential_matches)} potential matches in {total_batches} batches of {batch_size}")
+    # Every path below records offers as seen, except a failed notification,
+    # and all of them share the single save at the end
     
-    for i in range(0, len(potential_matches), batch_size):
-        batch_num = i // batch_size + 1
-        batch = potential_matches[i:i+batch_size]
-        logging.info(f"Processing batch {batch_num}/{total_batches} with {len(batch)} offers")
+    # If no potential matches from expanded field screening, we're done
+    if not potential_matches:
+        # With no potential matches, every new offer was ruled out by the
+        # prefilter, so recording those covers the whole feed
+        mark_deals_seen(seen_deals, rejected_offer_ids)
+        dirty = True
         
-        # Add delay between batches (except for the first one)
-        if i > 0:
-            delay = BASE_DELAY_BETWEEN_BATCHES + random.uniform(0.5, 2.0)
-            logging.info(f"Waiting {delay:.2f} seconds before processing next batch...")
-            time.sleep(delay)
+        result_message = "No matching deals found."
+        logging.info("No potential matches found in pre-filtering. Exiting.")
+    else:
+        # Step 3: Fetch details for all potential matches; fetch_detailed_offers
+        # handles batching, rate limiting and retries
+        logging.info(f"Processing {len(potential_matches)} potential matches")
+        detailed_offers = fetch_detailed_offers(potential_matches)
         
-        # Fetch detailed information for this batch (with retry logic built in)
-        detailed_offers = fetch_detailed_offers(batch)
+        # NEW: Track processed IDs but don't add to seen_deals yet. The same pass
+        # drops details whose ID is already seen (Id can differ from the OfferId
+        # the prefilter checked), so filter_deals only scans the fields of new deals.
+        processed_deal_ids = set()
+        new_detailed_offers = []
+        for deal in detailed_offers:
+            unique_id = get_offer_id(deal)
+            if unique_id:
+                processed_deal_ids.add(unique_id)
+                if unique_id in seen_deals:
+                    continue
+            new_detailed_offers.append(deal)
         
         # Step 4: Filter for new matching deals (full check with all fields)
-        batch_matching_deals = filter_deals(detailed_offers, seen_deals)
-        
-        # Add new matches to our results list
-        all_matching_deals.extend(batch_matching_deals)
+        all_matching_deals = filter_deals(new_detailed_offers, seen_deals)
         
-        # NEW: Track processed IDs but don't add to seen_deals yet
-        for deal in detailed_offers:
-            unique_id = deal.get("Id", deal.get("OfferId"))
-            if unique_id and unique_id not in processed_deal_ids:
-                processed_deal_ids.append(unique_id)
-    
-    # Send notifications if we found any matching deals
-    if all_matching_deals:
-        logging.info(f"Found a total of {len(all_matching_deals)} new matching deals. Sending notifications.")
-        try:
-            # Attempt to send notifications
-            send_notifications(all_matching_deals)
-            
-            # Only NOW add the deals to the seen list - AFTER successful notification
-            # Add matching deals to seen_deals
-            for deal in all_matching_deals:
-                unique_id = deal.get("Id", deal.get("OfferId"))
-                if unique_id and unique_id not in seen_deals:
-                    seen_deals.append(unique_id)
-            
-            # NEW: Add remaining processed deals (non-matching deals) to seen_deals
-            for deal_id in processed_deal_ids:
-                if deal_id not in seen_deals:
-                    seen_deals.append(deal_id)
-            
-            # Save updated seen deals list
-            save_seen_deals(seen_deals)
+        # Send notifications if we found any matching deals
+        if all_matching_deals:
+            logging.info(f"Found a total of {len(all_matching_deals)} new matching deals. Sending notifications.")
+            if send_notifications(all_matching_deals):
+                # Only NOW add the deals to the seen list - AFTER successful notification.
+                # processed_deal_ids already holds the matching deals as well as the
+                # non-matching ones, and offers the prefilter ruled out won't match
+                # next time either, so record them all in one pass.
+                mark_deals_seen(seen_deals, itertools.chain(processed_deal_ids, rejected_offer_ids))
+                dirty = True
+                
+                result_message = f"Found and notified about {len(all_matching_deals)} new deals"
+                logging.info(result_message)
+            else:
+                # If notification fails, don't mark deals as seen so they're retried
+                result_message = "Error sending notifications. Check logs for details."
+                logging.error(result_message)
+        else:
+            # No matching deals found, but still mark processed IDs and offers the
+            # prefilter ruled out as seen. Potential matches whose details couldn't
+            # be fetched are left out so they're retried.
+            mark_deals_seen(seen_deals, itertools.chain(processed_deal_ids, rejected_offer_ids))
+            dirty = True
             
-            result_message = f"Found and notified about {len(all_matching_deals)} new deals"
+            result_message = "No new matching deals found."
             logging.info(result_message)
-            return result_message
+    
+    # Save updated seen deals list
+    if dirty:
+        save_seen_deals(seen_deals, seen_deals_generation)
+    
+    return result_message
+    
+def log_sample_item_matches(items):
+    """
+    Run the prefilter over the first 50 feed items and log which keywords
+    matched in which fields. Used by test_woot_api_structure for both shapes
+    of feed response.
+    """
+    if not items:
+        return
+    
+    # Sample available fields in first item
+    logging.info(f"Sample item fields: {list(items[0].keys())}")
+    
+    # Check if our keywords are present in any items at all (expanded search)
+    total_matches = 0
+    checked_items = min(50, len(items))  # Check more items
+    
+    for i, item in enumerate(items[:checked_items]):
+        # Test our improved matching function
+        if improved_title_contains_keywords(item):
+            total_matches += 1
+            logging.info(f"Item {i} matches using improved prefiltering")
             
-        except Exception as e:
-            # If notification fails, don't mark deals as seen
-            logging.error(f"Failed to send notifications: {e}")
-            logging.error(traceback.format_exc())
-            return f"Error sending notifications: {e}"
-    else:
-        # No matching deals found, but still mark processed IDs as seen
-        for deal_id in processed_deal_ids:
-            if deal_id not in seen_deals:
-                seen_deals.append(deal_id)
-        
-        # Also mark any remaining IDs from all_offer_ids as seen
-        for deal_id in all_offer_ids:
-            if deal_id not in seen_deals:
-                seen_deals.append(deal_id)
-        
-        save_seen_deals(seen_deals)
-        
-        result_message = "No new matching deals found."
-        logging.info(result_message)
-        return result_message
+            # Log which keywords were found and in which fields, with one
+            # regex scan per field rather than one substring test per keyword
+            for field, value in item.items():
+                if not isinstance(value, str):
+                    continue
+                preview = value[:50] + "..." if len(value) > 50 else value
+                for keyword in dict.fromkeys(match.lower() for match in KEYWORD_RE.findall(value)):
+                    logging.info(f"Keyword '{keyword}' found in field '{field}': '{preview}'")
     
+    logging.info(f"Found {total_matches} matching items out of {checked_items} checked items using improved_title_contains_keywords()")
+
 def test_woot_api_structure():
     """Test the Woot API response structure and prefiltering logic."""
     logging.info("=== TESTING WOOT API STRUCTURE AND PREFILTERING ===")
@@ -1006,18 +1530,13 @@ def test_woot_api_structure():
         logging.error("WOOT_API_KEY is not set")
         return False
     
-    headers = {
-        "x-api-key": WOOT_API_KEY,
-        "Accept": "application/json"
-    }
-    
     try:
         # Test the feed endpoint
         logging.info(f"Testing connection to feed endpoint: {FEED_ENDPOINT}")
-        response = requests.get(FEED_ENDPOINT, headers=headers)
+        response = woot_request("GET", FEED_ENDPOINT)
         
         if response.status_code == 200:
-            api_response = response.json()
+            api_response = orjson.loads(response.content)
             logging.info(f"Successfully connected to feed endpoint. Received response data.")
             
             # Log the response structure type
@@ -1036,30 +1555,7 @@ def test_woot_api_structure():
                     
                     logging.info(f"Found items list in field '{items_field}' with {len(items_data)} items")
                     
-                    # Sample available fields in first item
-                    if items_data and len(items_data) > 0:
-                        sample_item = items_data[0]
-                        logging.info(f"Sample item fields: {list(sample_item.keys())}")
-                        
-                        # Check if our keywords are present in any items at all (expanded search)
-                        total_matches = 0
-                        checked_items = min(50, len(items_data))  # Check more items
-                        
-                        for i, item in enumerate(items_data[:checked_items]):
-                            # Test our improved matching function
-                            if improved_title_contains_keywords(item):
-                                total_matches += 1
-                                logging.info(f"Item {i} matches using improved prefiltering")
-                                
-                                # Log which keywords were found and in which fields
-                                for field in item.keys():
-                                    if isinstance(item[field], str):
-                                        for keyword in KEYWORDS:
-                                            if keyword.lower() in item[field].lower():
-                                                preview = item[field][:50] + "..." if len(item[field]) > 50 else item[field]
-                                                logging.info(f"Keyword '{keyword}' found in field '{field}': {preview}")
-                            
-                        logging.info(f"Found {total_matches} matching items out of {checked_items} checked items using improved_title_contains_keywords()")
+                    log_sample_item_matches(items_data)
                     
                 else:
                     logging.warning("Could not find Items list in the response")
@@ -1067,30 +1563,7 @@ def test_woot_api_structure():
             elif isinstance(api_response, list):
                 logging.info(f"API response is a LIST with {len(api_response)} items")
                 
-                # Sample available fields in first item
-                if api_response and len(api_response) > 0:
-                    sample_item = api_response[0]
-                    logging.info(f"Sample item fields: {list(sample_item.keys())}")
-                    
-                    # Check if our keywords are present in any items at all (expanded search)
-                    total_matches = 0
-                    checked_items = min(50, len(api_response))  # Check more items
-                    
-                    for i, item in enumerate(api_response[:checked_items]):
-                        # Test our improved matching function 
-                        if improved_title_contains_keywords(item):
-                            total_matches += 1
-                            logging.info(f"Item {i} matches using improved prefiltering")
-                            
-                            # Log which keywords were found and in which fields
-                            for field in item.keys():
-                                if isinstance(item[field], str):
-                                    for keyword in KEYWORDS:
-                                        if keyword.lower() in item[field].lower():
-                                            preview = item[field][:50] + "..." if len(item[field]) > 50 else item[field]
-                                            logging.info(f"Keyword '{keyword}' found in field '{field}': '{preview}'")
-                
-                logging.info(f"Found {total_matches} matching items out of {checked_items} checked items using improved_title_contains_keywords()")
+                log_sample_item_matches(api_response)
             
             return True
         else:
@@ -1098,25 +1571,48 @@ def test_woot_api_structure():
             logging.error(f"Response: {response.text}")
             return False
     except Exception as e:
-        logging.error(f"Error testing Woot API structure: {e}")
-        logging.error(traceback.format_exc())
+        logging.exception(f"Error testing Woot API structure: {e}")
         return False
 
+def run_profiled(func, *args):
+    """Run func under cProfile and log its 30 most expensive calls by cumulative time."""
+    import cProfile
+    import io
+    import pstats
+    
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        stats_output = io.StringIO()
+        pstats.Stats(profiler, stream=stats_output).sort_stats("cumulative").print_stats(30)
+        logging.info(f"Profile for {func.__name__}:\n{stats_output.getvalue()}")
+
+# Diagnostics selectable with ?test=, mapped to the function and its name in the response
+TEST_MODES = {
+    "env": (test_environment_variables, "Environment variables test"),
+    "storage": (test_storage_access, "Storage access test"),
+    "api": (test_woot_api, "Woot API test"),
+    "email": (test_email, "Email test"),
+    "structure": (test_woot_api_structure, "Woot API structure test"),
+    "all": (run_all_tests, "All diagnostic tests")
+}
+
 # Add catch-all route handlers
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
+@app.route('/', defaults={'path': ''}, methods=['GET', 'POST'])
+@app.route('/<path:path>', methods=['GET', 'POST'])
 def catch_all(path):
     try:
         if path == 'health':
             return "OK", 200
-        elif request.args.get('test'):
-            test_mode = request.args.get('test')
-            return check_woot_deals(request)
-        else:
-            return check_woot_deals(request)
+        # check_woot_deals handles ?test= itself; only regular runs are profiled
+        if PROFILE_ENABLED and not request.args.get('test'):
+            return run_profiled(check_woot_deals, request)
+        return check_woot_deals(request)
     except Exception as e:
-        logging.error(f"Error handling request: {e}")
-        logging.error(traceback.format_exc())
+        logging.exception(f"Error handling request: {e}")
         return f"Error: {str(e)}", 500
 
 # Keep the health endpoint for backward compatibility
@@ -0,0 +1,22 @@
+import os
+import unittest
+
+os.environ.setdefault("GMAIL_USER", "user@example.com")
+
+import main
+
+class FormatDealNotificationsTest(unittest.TestCase):
+    def test_null_url_and_title(self):
+        # The API sends null for missing fields rather than leaving them out
+        title, email_body, text_message = main.format_deal_notifications({"Id": "1", "Title": None, "Url": None})
+        self.assertEqual(title, "No Title")
+        self.assertIn("No URL", email_body)
+        self.assertTrue(text_message.startswith("No Title"))
+
+    def test_escapes_title(self):
+        title, email_body, _ = main.format_deal_notifications({"Id": "2", "Title": "Kindle <b>", "Url": "https://woot.com/x"})
+        self.assertEqual(title, "Kindle <b>")
+        self.assertIn("Kindle &lt;b&gt;", email_body)
+
+if __name__ == "__main__":
+    unittest.main()